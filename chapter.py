@@ -4,10 +4,12 @@ A model of a chapter of a manga.
 
 import logging
 import weakref
-from bs4 import BeautifulSoup
 
 from page import Page
 from downloader import Downloader
+from soup import makeSoup
+from filenames import makeSafeFilename, internName
+import impl
 from impl import getSampleImageUrls
 
 
@@ -25,15 +27,26 @@ class Chapter:
         url (str): The URL of the main manga page.
         title (str): The title of the manga.
         pages (list of Page): List of the pages of the manga.
+
+    Note:
+        The attributes are declared in __slots__, which keeps the many chapters small.
+        A subclass without its own __slots__ declaration would bring back the __dict__.
     """
 
+    __slots__ = ('_manga', 'mangaTitle', 'num', 'url', 'title', '_directoryName', 'pages',
+                 '__weakref__')
+
+    # The elements of the chapter HTML that are parsed into the soup (see makeSoup)
+    PARSE_STRAINER = getattr(impl, 'CHAPTER_PARSE_STRAINER', None)
+
     ################################################################################################
     # INITIALIZATION
     ################################################################################################
 
     def __init__(self, manga, num, url, title=None, pages=None):
         self._manga = weakref.ref(manga)
-        self.mangaTitle = manga.title
+        # Interned so that the chapters, and the pages after them, all share one title string
+        self.mangaTitle = internName(manga.title)
         self.num = num
         self.url = url
         self.title = title
@@ -41,30 +54,45 @@ class Chapter:
         self.pages = pages if pages is not None else []
 
     @classmethod
-    def fromJson(cls, manga, jsonData):
+    def fromJsonList(cls, manga, jsonList):
         """
-        Instantitate a Chapter from its JSON representation.
+        Instantitate a list of Chapters from their JSON representations.
 
         Parameters:
-            manga (Manga): The parent manga who owns this chapter.
-            jsonData (json): The JSON representation of the chapter.
+            manga (Manga): The parent manga who owns these chapters.
+            jsonList (list of json): The JSON representations of the chapters.
 
         Returns:
-            Chapter: The instantiated Chapter.
+            list of Chapter: The instantiated Chapters.
         """
+        chapters = []
+        for jsonData in jsonList:
+            # Instantiate the Chapter without pages first, then its pages by passing the chapter
+            chapter = cls(manga, jsonData['num'], jsonData['url'], jsonData['title'])
+            chapter.pages = Page.fromJsonList(chapter, jsonData['pages'])
+            chapters.append(chapter)
 
-        num = jsonData['num']
-        url = jsonData['url']
-        title = jsonData['title']
+        return chapters
 
-        # Instantiate the Chapter without pages for now
-        chapter = cls(manga, num, url, title)
+    @classmethod
+    def fromStateList(cls, manga, stateList):
+        """
+        Instantitate a list of Chapters from their tuple representations (see toState).
 
-        # Instantiate the pages by passing the chapter
-        pages = [Page.fromJson(chapter, page) for page in jsonData['pages']]
-        chapter.pages = pages
+        Parameters:
+            manga (Manga): The parent manga who owns these chapters.
+            stateList (list of tuple): The tuple representations of the chapters.
 
-        return chapter
+        Returns:
+            list of Chapter: The instantiated Chapters.
+        """
+        chapters = []
+        for num, url, title, pageStates in stateList:
+            chapter = cls(manga, num, url, title)
+            chapter.pages = Page.fromStateList(chapter, pageStates)
+            chapters.append(chapter)
+
+        return chapters
 
     ################################################################################################
     # PROPERTIES
@@ -99,12 +127,7 @@ class Chapter:
 
         logger.debug("Converting chapter title (%s) to manga directory name...", self.title)
 
-        chapterDirName = self.title
-        invalidFilenameChars = '<>:"/\\|?*.'
-        for invalidChar in invalidFilenameChars:
-            chapterDirName = chapterDirName.replace(invalidChar, '_')
-
-        self._directoryName = chapterDirName
+        self._directoryName = makeSafeFilename(self.title)
 
         logger.debug("Directory name of Chapter '%s' is '%s'.", self.title, self._directoryName)
         return self._directoryName
@@ -201,7 +224,7 @@ class Chapter:
             manga (Manga): The new manga parent.
         """
         self._manga = weakref.ref(manga)
-        self.mangaTitle = manga.title
+        self.mangaTitle = internName(manga.title)
 
     ################################################################################################
     # UPDATE
@@ -227,7 +250,7 @@ class Chapter:
                      self.mangaTitle, self.num, self.url)
 
         logger.debug("Parsing '%s' Chapter %d into soup...", self.mangaTitle, self.num)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = makeSoup(response.content, response.encoding or 'utf-8', self.PARSE_STRAINER)
         logger.debug("Successfully parsed '%s' Chapter %d into soup.", self.mangaTitle, self.num)
 
         self.updateWithSoup(soup)
@@ -272,6 +295,12 @@ class Chapter:
         pages = 'No pages' if len(self.pages) == 0 else f'{len(self.pages)} pages'
         return f'Chapter {self.num}: {self.url}  ({title})  ({pages})'
 
+    def toState(self):
+        """
+        Returns the compact tuple representation of the Chapter, used by the pickle cache.
+        """
+        return (self.num, self.url, self.title, [page.toState() for page in self.pages])
+
     def toDict(self):
         """
         Returns the dictionary representation of the Chapter.
@@ -5,14 +5,24 @@ Class that provides the functionality to crawl a manga.
 import os
 import logging
 from time import sleep
-from queue import Queue
+from collections import deque
+from itertools import islice
+from queue import Queue, Empty, Full
 from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
 
 from manga import Manga
+from page import Page
+from pool import AdaptivePool
 
 
 logger = logging.getLogger(__name__)
 
+# The maximum number of fetched chapters waiting for their images to be downloaded.
+# While the page thread downloads the images of one chapter, the chapter threads fetch
+# the next chapters ahead of it, and this bounds how far ahead they can get.
+DOWNLOAD_QUEUE_MAX_SIZE = 2
+
 
 class MangaCrawler:
     """
@@ -21,19 +31,23 @@ class MangaCrawler:
     Parameters:
         mangaUrls (list of str): The list of manga URLs to crawl.
         chapterThreadCount (int): The number of chapter download threads.
-        pageThreadCount (int): The number of page download threads.
+        pageThreadCount (int): The maximum number of images of a chapter that are downloaded
+            at once. The actual number starts lower and adapts to how the host responds.
         outputDir (str): The output directory.
+        mangaThreadCount (int): The number of threads that fetch the mangas.
     """
 
     ################################################################################################
     # INITIALIZATION
     ################################################################################################
 
-    def __init__(self, mangaUrls, chapterThreadCount, pageThreadCount, outputDir):
+    def __init__(self, mangaUrls, chapterThreadCount, pageThreadCount, outputDir,
+                 mangaThreadCount=1):
         self.mangaUrls = mangaUrls
         self.chapterThreadCount = chapterThreadCount
         self.pageThreadCount = pageThreadCount
-        self.outputDir = outputDir
+        self.outputDir = os.path.abspath(outputDir)  # Resolved once instead of once per page
+        self.mangaThreadCount = mangaThreadCount
 
         # The attribute isCrawling is true if the crawling process is currently ongoing.
         self.isCrawling = False
@@ -57,6 +71,9 @@ class MangaCrawler:
         # The collection of pages that failed to be downloaded.
         self._failedPages = Queue()
 
+        # The pool that downloads the page images, created when the crawling starts.
+        self._pool = None
+
     ################################################################################################
     # CRAWL
     ################################################################################################
@@ -76,43 +93,47 @@ class MangaCrawler:
 
         logger.info('Start crawling through %d mangas...', len(self.mangaUrls))
 
+        # All the chapters share the pool, so that what it learns about how many
+        # simultaneous downloads the host allows carries over from chapter to chapter
+        self._pool = AdaptivePool(maxConcurrency=self.pageThreadCount)
+
+        mangas = self.fetchMangas()
         try:
-            for mangaUrl in self.mangaUrls:
-                self._crawl(mangaUrl)
+            for manga in mangas:
+                self._crawl(manga)
         except KeyboardInterrupt:
             # If Ctrl+C is pressed by the user, send a kill signal
             # and wait for the threads to finish.
             logger.info('Keyboard interrupt detected.')
             self.stop()
+        finally:
+            # Cancel the mangas that are still waiting to be fetched
+            mangas.close()
+            self._pool.shutdown()
 
         # Print the list of chapters and pages that weren't downloaded
         self.displayUnsuccessfulItems()
 
-    def _crawl(self, mangaUrl):
+    def _crawl(self, manga):
         """
-        Crawl through and download the given manga URL.
+        Crawl through and download the given manga.
         Can be interrupted by Ctrl+C.
         """
 
-        logger.info('Downloading manga: %s...', mangaUrl)
+        logger.info('Downloading manga: %s...', manga.url)
 
-        # Fetch the manga and merge with the cached version
-        self.fetchManga(mangaUrl)
-
-        # Cannot continue to crawl if something went wrong while fetching manga
-        if self.manga is None:
-            return
+        self.manga = manga
 
         # Create the queues
         chapterQueue = Queue()
-        pageQueue = Queue()
+        downloadQueue = Queue(maxsize=DOWNLOAD_QUEUE_MAX_SIZE)
 
-        # Create the chapter processor threads and the page downloader threads
-        self.startThreads(chapterQueue, pageQueue)
+        # Create the chapter processor threads and the page downloader thread
+        self.startThreads(chapterQueue, downloadQueue)
 
         # Wait until either the manga is finished downloading
         # or the user interrupts the process by pressing Ctrl + C.
-        self.waitForCompletion(pageQueue)
+        self.waitForCompletion(downloadQueue)
 
         # Save the manga cache file
         self.saveManga()
@@ -121,10 +142,42 @@ class MangaCrawler:
     # FETCH MANGA
     ################################################################################################
 
+    def fetchMangas(self):
+        """
+        Fetch the mangas in the list, using up to `mangaThreadCount` threads
+        so that the next mangas are fetched while the current one is being crawled.
+
+        Only `mangaThreadCount` mangas are fetched ahead of the one being crawled,
+        and the ones that haven't started are cancelled when the generator is closed.
+
+        Yields:
+            Manga: The mangas that were fetched successfully, in the order of the list.
+        """
+        mangaUrls = iter(self.mangaUrls)
+        executor = ThreadPoolExecutor(max_workers=self.mangaThreadCount,
+                                      thread_name_prefix='MangaFetcherThread')
+        try:
+            futures = deque(executor.submit(self.fetchManga, mangaUrl)
+                            for mangaUrl in islice(mangaUrls, self.mangaThreadCount))
+            while futures:
+                manga = futures.popleft().result()
+
+                # Start fetching the next manga in place of the one that is done
+                mangaUrl = next(mangaUrls, None)
+                if mangaUrl is not None:
+                    futures.append(executor.submit(self.fetchManga, mangaUrl))
+
+                if manga is not None:
+                    yield manga
+        finally:
+            # Don't wait for the fetches that are already running,
+            # they can't be interrupted and their results aren't needed anymore
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def fetchManga(self, mangaUrl):
         """
-        Fetch the manga to be processed and set it to `self.manga`.
-        If something went wrong while fetching the manga, `self.manga` will be None.
+        Fetch the manga to be processed.
+        If something went wrong while fetching the manga, None will be returned.
 
         The manga will also be compared to its cached version,
         so that previously downloaded chapters and pages will not be downloaded again.
@@ -134,44 +187,47 @@ class MangaCrawler:
 
         Parameters:
             mangaUrl (str): The manga URL.
-        """
 
-        # First, set the manga to None
-        self.manga = None
+        Returns:
+            Manga: The fetched manga. None if the fetching failed.
+        """
 
         # Instantiate a freshly fetched manga
         try:
-            self.manga = Manga(mangaUrl)
-            self.manga.fetch()
+            manga = Manga(mangaUrl)
+            manga.fetch()
         except Exception as err:  # pylint: disable=broad-except
             logger.error('Failed to fetch manga %s, %s', mangaUrl, err)
             logger.exception(err)
-            return
+            return None
 
         # Compare the freshly fetched manga from the cached version.
-        cachePath = os.path.join(self.outputDir, self.manga.directoryName, 'cache.json')
+        cachePath = os.path.join(self.outputDir, manga.directoryName, 'cache.json')
         if os.path.exists(cachePath):
-            logger.info('Loading previous download info of %s...', self.manga.title)
+            logger.info('Loading previous download info of %s...', manga.title)
             try:
-                self.manga.updateFromCache(cachePath)
-                logger.info("Manga '%s' has been updated from the cache.", self.manga.title)
+                manga.updateFromCache(cachePath)
+                logger.info("Manga '%s' has been updated from the cache.", manga.title)
             except Exception as err:  # pylint: disable=broad-except
                 logger.error("Failed to retrieve previous download info about '%s', %s",
-                             self.manga.title, err)
+                             manga.title, err)
         else:
-            logger.info('No previous download info about %s exists in cache.', self.manga.title)
+            logger.info('No previous download info about %s exists in cache.', manga.title)
+
+        return manga
 
     ################################################################################################
     # START THREADS
     ################################################################################################
 
-    def startThreads(self, chapterQueue, pageQueue):
+    def startThreads(self, chapterQueue, downloadQueue):
         """
-        Start the chapter processor threads and the page downloader threads.
+        Start the chapter processor threads and the page downloader thread.
 
         Parameters:
             chapterQueue (Queue of Chapter): The queue containing the chapters to be processed.
-            pageQueue (Queue of Page): The queue containing the pages to be downloaded.
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
         """
 
         # Reset the end event
@@ -201,32 +257,32 @@ class MangaCrawler:
         for idx in range(self.chapterThreadCount):
             threadName = f'ChapterDownloaderThread{idx+1}'
             t = Thread(name=threadName, target=self.chapterWorker,
-                       args=(threadName, chapterQueue, pageQueue))
+                       args=(threadName, chapterQueue, downloadQueue))
             self._chapterThreads.append(t)
             t.start()
 
-        # Start the page downloader threads
-        for _ in range(self.pageThreadCount):
-            threadName = f'PageDownloaderThread{idx+1}'
-            t = Thread(name=threadName, target=self.pageWorker,
-                       args=(threadName, pageQueue))
-            self._pageThreads.append(t)
-            t.start()
+        # Start the page downloader thread. It downloads the pages of one chapter at a time,
+        # up to `pageThreadCount` of them at once.
+        threadName = 'PageDownloaderThread'
+        t = Thread(name=threadName, target=self.pageWorker, args=(threadName, downloadQueue))
+        self._pageThreads.append(t)
+        t.start()
 
     ################################################################################################
     # WAIT FOR COMPLETION
     ################################################################################################
 
-    def waitForCompletion(self, pageQueue):
+    def waitForCompletion(self, downloadQueue):
         """
         Wait until the manga has finished downloading.
 
         Parameters:
-            pageQueue (Queue of Page): The queue containing the pages to be downloaded.
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
         """
 
-        # Wait until both chapterQueue and pageQueue are empty
-        while not self._endEvent.is_set() or not pageQueue.empty():
+        # Wait until both chapterQueue and downloadQueue are empty
+        while not self._endEvent.is_set() or not downloadQueue.empty():
             sleep(0.3)
 
         # Wait for all the threads to finish
@@ -246,7 +302,7 @@ class MangaCrawler:
     # PROCESS CHAPTER
     ################################################################################################
 
-    def chapterWorker(self, threadName, chapterQueue, pageQueue):
+    def chapterWorker(self, threadName, chapterQueue, downloadQueue):
         """
         Work function of the chapter threads which contains the loop
         that continues until all the chapters in the chapter queue have been processed.
@@ -255,7 +311,8 @@ class MangaCrawler:
         Parameters:
             threadName (str): The thread name.
             chapterQueue (Queue of Chapter): The queue containing the chapters to be processed.
-            pageQueue (Queue of Page): The queue containing the pages to be downloaded.
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
         """
         # Loop until all the chapters in the queue have been processed
         while not chapterQueue.empty():
@@ -269,7 +326,7 @@ class MangaCrawler:
             chapter = chapterQueue.get()
 
             # Process the chapter
-            self.processChapter(chapter, pageQueue)
+            self.processChapter(chapter, downloadQueue)
 
             # Now that the chapter has been processed, check if the chapterQueue is empty
             if chapterQueue.empty():
@@ -281,16 +338,17 @@ class MangaCrawler:
             # Notify the queue that the chapter is done processing
             chapterQueue.task_done()
 
-    def processChapter(self, chapter, pageQueue):
+    def processChapter(self, chapter, downloadQueue):
         """
         Download and parse the chapter HTML and update the chapter info.
 
         This will update the chapter title and create the list of Pages.
-        These pages will then be added onto the pageQueue so they can be downloaded.
+        The chapter will then be added onto the downloadQueue so its pages can be downloaded.
 
         Parameters:
             chapter (Chapter): The chapter to be processed.
-            pageQueue (Queue of Page): The queue containing the pages to be downloaded.
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
         """
         # If all the pages of the chapter have been downloaded, there is nothing to do here
         if chapter.isDownloaded:
@@ -317,80 +375,102 @@ class MangaCrawler:
             chapterReady = True
 
         if chapterReady:
-            # Put all the pages in the pageQueue
-            for page in chapter.pages:
-                if self._killEvent.is_set():
-                    break
-                logger.debug("Adding '%s' chapter %d page %d to the page queue.",
-                             page.mangaTitle, chapter.num, page.num)
-                pageQueue.put(page)
-
             # Save the manga cache file
             self.saveManga()
 
+            # Put the chapter in the downloadQueue
+            logger.debug("Adding '%s' chapter %d to the download queue.",
+                         chapter.mangaTitle, chapter.num)
+            self._putChapter(downloadQueue, chapter)
+
+    def _putChapter(self, downloadQueue, chapter):
+        """
+        Put the chapter in the download queue, waiting while the queue is full.
+
+        Parameters:
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
+            chapter (Chapter): The chapter whose pages are to be downloaded.
+
+        Returns:
+            bool: False if the kill event was set before the chapter could be queued.
+        """
+        while not self._killEvent.is_set():
+            try:
+                downloadQueue.put(chapter, timeout=0.3)
+                return True
+            except Full:
+                pass
+        return False
+
     ################################################################################################
     # PROCESS PAGE
     ################################################################################################
 
-    def pageWorker(self, threadName, pageQueue):
+    def pageWorker(self, threadName, downloadQueue):
         """
-        Work function of the page threads which contains the loop
-        that continues until all the pages in the page queue have been processed.
-        (Or until the user interrupts by pressing Ctrl + C.)
+        Work function of the page thread which contains the loop
+        that continues until the pages of all the chapters in the download queue
+        have been processed. (Or until the user interrupts by pressing Ctrl + C.)
 
         Parameters:
             threadName (str): The thread name.
-            pageQueue (Queue of Page): The queue containing the pages to be downloaded.
+            downloadQueue (Queue of Chapter): The queue containing the processed chapters
+                whose pages are to be downloaded.
         """
-        # The page thread will end if the endEvent is set and the pageQueue is empty
-        while not self._endEvent.is_set() or not pageQueue.empty():
+        # The page thread will end if the endEvent is set and the downloadQueue is empty
+        while not self._endEvent.is_set() or not downloadQueue.empty():
 
             # If the kill event is set, terminate the thread
             if self._killEvent.is_set():
                 logger.debug('Kill event is set, terminating %s...', threadName)
                 break
 
-            # If the pageQueue is empty, do nothing
-            if not pageQueue.empty():
-                page = pageQueue.get()
-                self.processPage(page)
-                pageQueue.task_done()
+            # If the downloadQueue is empty, check the events again
+            try:
+                chapter = downloadQueue.get(timeout=0.3)
+            except Empty:
+                continue
+
+            self.processPages(chapter)
+            downloadQueue.task_done()
 
-    def processPage(self, page):
+    def processPages(self, chapter):
         """
-        Download the page image and update the page info.
+        Download the page images of the chapter and update the page info.
+        The pages that have already been downloaded are skipped.
 
         Parameters:
-            page (Page): The page to be downloaded.
+            chapter (Chapter): The processed chapter whose pages are to be downloaded.
         """
-        # If the page has already been downloaded, there is nothing to do here
-        if page.isDownloaded:
-            logger.debug("Skipping '%s' chapter %d page %d...",
-                         page.mangaTitle, page.chapterNum, page.num)
-            page.isProcessed = True
-            return
-
-        logger.info("Processing '%s' chapter %d page %d...",
-                    page.mangaTitle, page.chapterNum, page.num)
+        logger.info("Downloading the pages of '%s' chapter %d...", chapter.mangaTitle, chapter.num)
 
+        # The whole chapter is downloaded as one batch, so the chapter directory
+        # is created once and pages with the same image are only downloaded once
         try:
-            # Try to download the image
-            page.downloadImage(self.outputDir)
+            failedPages = Page.downloadImagesBatch(chapter.pages, self.outputDir,
+                                                   pool=self._pool, stopEvent=self._killEvent)
         except Exception as err:  # pylint: disable=broad-except
-            logger.error("Failed to download image: '%s' page %d of chapter %d (%s), %s",
-                         page.mangaTitle, page.num, page.chapterNum, page.imageUrl, err)
+            logger.error("Failed to download the pages of '%s' chapter %d, %s",
+                         chapter.mangaTitle, chapter.num, err)
             logger.exception(err)
-            self._failedPages.put(page)
+            failedPages = []
+            for page in chapter.pages:
+                if not page.isDownloaded:
+                    page.isProcessed = True
+                    self._failedPages.put(page)
 
-        page.isProcessed = True
+        for page, err in failedPages:
+            logger.error("Failed to download image: '%s' page %d of chapter %d (%s), %s",
+                         page.mangaTitle, page.num, page.chapterNum, page.imageUrl, err,
+                         exc_info=err)
+            self._failedPages.put(page)
 
-        # Regardless if the page was downloaded successfully or not,
-        # as long as the page was not skipped, once it has finished processing,
-        # we can check the page's chapter if all its pages are either already downloaded
-        # or have been processed.
-        if page.chapter.isProcessed:
-            logger.info("Finished processing '%s' chapter %d.", page.mangaTitle, page.chapterNum)
-            self.saveManga()
+        # Unless the download was stopped, all the pages have either been downloaded
+        # or failed to be downloaded by now
+        if chapter.isProcessed:
+            logger.info("Finished processing '%s' chapter %d.", chapter.mangaTitle, chapter.num)
+        self.saveManga()
 
     ################################################################################################
     # STOP
@@ -411,6 +491,10 @@ class MangaCrawler:
             logger.info('Stopping threads... Please wait for active threads to finish...')
             self._killEvent.set()
 
+            # Cancel the downloads that are waiting for their turn in the pool
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancelFutures=True)
+
             if self._chapterThreads:
                 for t in self._chapterThreads:
                     if isinstance(t, Thread):
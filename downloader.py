@@ -2,15 +2,210 @@
 Provides high-level functions for fetching stuff from the internet.
 """
 
+import os
 import shutil
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# The buffer size used when writing downloaded images to disk
+IMAGE_BUFFER_SIZE = 1 << 20
+
+# The size of the chunks read from the response. When the connection drops, the chunk being
+# read is lost, so it is kept smaller than the write buffer to keep more of a partial download.
+IMAGE_CHUNK_SIZE = 1 << 16
+
+# An image is downloaded into a partial file next to its output path, and only moved to the
+# output path once it is complete. The info file records which version of the image the
+# partial file belongs to, so that an interrupted download can be resumed safely.
+PARTIAL_SUFFIX = '.part'
+PARTIAL_INFO_SUFFIX = '.part.info'
+
+# The number of hosts whose connections are pooled, and the number of connections kept per host.
+# The pool size should be at least the number of page threads so that none of them has to wait.
+POOL_CONNECTIONS = 16
+POOL_MAXSIZE = 32
+
+# Connection errors are retried a few times, waiting longer after each attempt.
+# Throttling responses (429/503) are not retried here, even with a Retry-After header,
+# since the AdaptivePool has to see them to slow down the other downloads as well.
+MAX_RETRIES = Retry(total=3, backoff_factor=0.5, respect_retry_after_header=False)
+
+# The time in seconds to wait for a connection, and for each read from it, before giving up.
+# Without it, a host that stops responding would stall the chapter's batch, and the crawl, forever.
+REQUEST_TIMEOUT = (10, 30)
+
+# The session shared by all requests, so that connections to the same host are kept alive
+# and reused instead of paying for a new TCP and TLS handshake on every page
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+                       max_retries=MAX_RETRIES)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
+
+
+def _getFileSize(filePath):
+    """
+    Get the size of the file at the given path. Zero if there is none.
+    """
+    try:
+        return os.path.getsize(filePath)
+    except OSError:
+        return 0
+
+
+def _removeFile(filePath):
+    """
+    Remove the file at the given path if it exists.
+    """
+    try:
+        os.remove(filePath)
+    except FileNotFoundError:
+        pass
+
+
+def _getContentRange(response):
+    """
+    Get the start and the total size from the Content-Range header,
+    e.g. (3000, 5000) for 'bytes 3000-4999/5000' and (None, 5000) for 'bytes */5000'.
+    None if the header is missing or can't be parsed.
+    """
+    contentRange = response.headers.get('Content-Range', '')
+    unit, _, rangeSpec = contentRange.partition(' ')
+    byteRange, _, total = rangeSpec.partition('/')
+    if unit != 'bytes' or not total.isdigit():
+        return None
+    if byteRange == '*':
+        return None, int(total)
+    start = byteRange.partition('-')[0]
+    if not start.isdigit():
+        return None
+    return int(start), int(total)
+
+
+def _getValidator(response):
+    """
+    Get the value that identifies this version of the image, to be sent as If-Range
+    when resuming its download. None if the server didn't send a usable one.
+    """
+    etag = response.headers.get('ETag')
+    # If-Range only accepts strong entity tags
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _readPartialInfo(infoPath):
+    """
+    Read the total size and the validator of the image that the partial file belongs to.
+    None if there is no info file or it can't be read.
+    """
+    try:
+        with open(infoPath, 'r', encoding='utf-8') as infoFile:
+            total, validator = infoFile.read().split('\n', 1)
+        return int(total), validator
+    except (OSError, ValueError):
+        return None
+
+
+def _writePartialInfo(infoPath, total, validator):
+    """
+    Record the total size and the validator of the image that the partial file belongs to.
+    """
+    with open(infoPath, 'w', encoding='utf-8') as infoFile:
+        infoFile.write(f'{total}\n{validator}')
+
+
+def _isAlreadyDownloaded(url, outputPath):
+    """
+    Check whether the file at the output path is the complete image,
+    e.g. one that was downloaded before the download was recorded in the cache.
+
+    Only one request is needed: the range past the end of the file is requested,
+    and the server says how big the image is when it turns out that there is nothing left.
+    """
+    size = _getFileSize(outputPath)
+    if size == 0:
+        return False
+    headers = {'Range': f'bytes={size}-', 'Accept-Encoding': 'identity'}
+    with _session.get(url, headers=headers, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code == 416:
+            contentRange = _getContentRange(response)
+            return contentRange is not None and contentRange[1] == size
+        if response.status_code == 200:
+            # The server ignored the range, but its Content-Length still tells the size
+            return _getImageSize(response) == size
+    return False
+
+
+def _getImageSize(response):
+    """
+    Get the size of the image as it will be written to disk. Zero if it is unknown.
+    """
+    # The Content-Length of an encoded response is not the size of the decoded image
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        return 0
+    try:
+        return int(response.headers.get('Content-Length', 0))
+    except ValueError:
+        return 0
+
+
+def _openPreallocated(outputPath, size):
+    """
+    Open a new file for writing, with disk space for the given number of bytes
+    allocated up front so that the file doesn't have to be extended on every write.
+    The space is only allocated where the OS supports it (not on Windows or macOS).
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fileDesc = os.open(outputPath, flags, 0o644)
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fileDesc, 0, size)
+        except OSError:
+            pass
+    return os.fdopen(fileDesc, 'wb', buffering=IMAGE_BUFFER_SIZE)
+
+
+def _getRetryAfter(response):
+    """
+    Get the number of seconds that the Retry-After header asks to wait. None if there is none.
+    The header is either a number of seconds or an HTTP date.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retryDate = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retryDate.tzinfo is None:
+        retryDate = retryDate.replace(tzinfo=timezone.utc)
+    return max(0.0, (retryDate - datetime.now(timezone.utc)).total_seconds())
 
 
 class DownloaderError(Exception):
     """
     Errors related to the Downloader
+
+    Attributes:
+        statusCode (int): The HTTP status code of the response. None if not caused by one.
+        retryAfter (float): The seconds to wait before retrying, from the Retry-After header.
+            None if the server didn't send one.
     """
 
+    def __init__(self, message, statusCode=None, retryAfter=None):
+        super().__init__(message)
+        self.statusCode = statusCode
+        self.retryAfter = retryAfter
+
 
 class Downloader:
     """
@@ -39,7 +234,7 @@ class Downloader:
 
         try:
             # Fetch the data.
-            response = requests.get(url)
+            response = _session.get(url, timeout=REQUEST_TIMEOUT)
             # Raise exception if any.
             response.raise_for_status()
             # If there were no exceptions, the download was successful.
@@ -57,6 +252,11 @@ class Downloader:
         """
         Download an image to the given path.
 
+        Nothing is downloaded if the complete image is already at the path.
+        If an earlier attempt was interrupted, only the rest of the image is requested,
+        provided that the server confirms (with If-Range) that the image hasn't changed
+        since then. Otherwise, the whole image is downloaded again.
+
         Parameters:
             url (str): The image URL.
             outputPath (str): The full path (including filename) of the image.
@@ -66,12 +266,63 @@ class Downloader:
         """
         error = None
         try:
-            response = requests.get(url, stream=True)
-            if response.status_code != 200:
-                raise DownloaderError(f'Error: Status code {response.status_code}')
-            with open(outputPath, 'wb') as outputFile:
-                shutil.copyfileobj(response.raw, outputFile)
-            del response
+            if _isAlreadyDownloaded(url, outputPath):
+                return None
+
+            partialPath = outputPath + PARTIAL_SUFFIX
+            infoPath = outputPath + PARTIAL_INFO_SUFFIX
+
+            response = None
+            resumed = False
+            offset = _getFileSize(partialPath)
+            partialInfo = _readPartialInfo(infoPath) if offset > 0 else None
+            if partialInfo is not None and offset < partialInfo[0]:
+                total, validator = partialInfo
+                # The encoding has to be identity, since the offset counts the decoded bytes.
+                # If the image has changed, If-Range makes the server send all of it instead.
+                headers = {'Range': f'bytes={offset}-', 'If-Range': validator,
+                           'Accept-Encoding': 'identity'}
+                response = _session.get(url, headers=headers, stream=True,
+                                        timeout=REQUEST_TIMEOUT)
+                resumed = (response.status_code == 206
+                           and _getContentRange(response) == (offset, total))
+                if not resumed and response.status_code != 200:
+                    response.close()
+                    response = None
+
+            if response is None:
+                response = _session.get(url, stream=True, timeout=REQUEST_TIMEOUT)
+
+            # The body is streamed to disk in chunks, and the connection goes back
+            # to the pool when the block exits, even if the download failed midway
+            with response:
+                if not resumed and response.status_code != 200:
+                    raise DownloaderError(f'Error: Status code {response.status_code}',
+                                          response.status_code, _getRetryAfter(response))
+                # Let urllib3 undo any gzip/deflate content encoding while copying the raw stream
+                response.raw.decode_content = True
+                if resumed:
+                    partialFile = open(partialPath, 'ab', buffering=IMAGE_BUFFER_SIZE)
+                else:
+                    # Record the version of the image first, in case the download is interrupted
+                    size = _getImageSize(response)
+                    validator = _getValidator(response)
+                    if size > 0 and validator is not None:
+                        _writePartialInfo(infoPath, size, validator)
+                    else:
+                        _removeFile(infoPath)
+                    partialFile = _openPreallocated(partialPath, size)
+                with partialFile:
+                    try:
+                        shutil.copyfileobj(response.raw, partialFile, IMAGE_CHUNK_SIZE)
+                    finally:
+                        # Cut off any allocated space past what was written, so that the size
+                        # of an interrupted download is still the offset to resume it from
+                        partialFile.truncate()
+
+            # Only a complete image is ever moved to the output path
+            os.replace(partialPath, outputPath)
+            _removeFile(infoPath)
         except Exception as err:  # pylint: disable=broad-except
             error = err
         return error
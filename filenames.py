@@ -0,0 +1,36 @@
+"""
+Functions related to the names of mangas and chapters, and the files made from them.
+"""
+
+import sys
+
+
+# Translation table that replaces the characters that are invalid in Windows filenames
+_INVALID_FN_TABLE = str.maketrans({char: '_' for char in '<>:"/\\|?*.'})
+
+
+def makeSafeFilename(name):
+    """
+    Make a Windows file-safe version of the name by replacing the invalid characters.
+
+    Parameters:
+        name (str): The name, e.g. the title of a manga or a chapter.
+
+    Returns:
+        str: The name with each invalid character replaced by an underscore.
+    """
+    return name.translate(_INVALID_FN_TABLE)
+
+
+def internName(name):
+    """
+    Intern the name so that equal names share one object, e.g. the manga title
+    kept by each of its chapters and pages.
+
+    Parameters:
+        name (str): The name, or None.
+
+    Returns:
+        str: The interned name. None is returned as is.
+    """
+    return None if name is None else sys.intern(name)
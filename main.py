@@ -13,6 +13,7 @@ import impl
 
 logger = logging.getLogger(__name__)
 
+MANGA_THREAD_COUNT = 4
 CHAPTER_THREAD_COUNT = 1
 PAGE_THREAD_COUNT = 5
 
@@ -28,7 +29,7 @@ def main():
     os.makedirs(impl.OUTPUT_DIR, exist_ok=True)
 
     crawler = MangaCrawler(impl.MANGA_LIST, CHAPTER_THREAD_COUNT,
-                           PAGE_THREAD_COUNT, impl.OUTPUT_DIR)
+                           PAGE_THREAD_COUNT, impl.OUTPUT_DIR, MANGA_THREAD_COUNT)
     crawler.crawl()
 
 
@@ -4,17 +4,95 @@ A model of the manga to be downloaded.
 
 import os
 import json
+import pickle
 import logging
 from threading import Lock
-from bs4 import BeautifulSoup
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from chapter import Chapter
 from downloader import Downloader
+from soup import makeSoup
+from filenames import makeSafeFilename
+import impl
 from impl import getSampleTitle, getSampleChapterUrls
 
 
 logger = logging.getLogger(__name__)
 
+# The buffer size used when reading and writing the JSON cache file
+CACHE_BUFFER_SIZE = 1 << 20
+
+# Lock that guards the lazy creation of each manga's cache lock
+_cacheLockInitLock = Lock()
+
+# The version of the tuple layout in the pickle cache (see Manga.toState).
+# Sidecars of any other version are ignored and the JSON cache is loaded instead.
+PICKLE_CACHE_VERSION = 1
+
+
+def _dumpJson(obj):
+    """
+    Serialize the object into UTF-8 encoded JSON, using orjson if it is installed.
+    The fallback is formatted like orjson's output, so the cache file is the same either way.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def _loadJson(data):
+    """
+    Deserialize the UTF-8 encoded JSON, using orjson if it is installed.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _writeFile(filePath, data, sync):
+    """
+    Write the data into the file, replacing its contents.
+
+    Parameters:
+        filePath (str): The path of the file.
+        data (bytes): The data to be written.
+        sync (bool): If True, make sure that the data reached the disk before returning.
+    """
+    with open(filePath, 'wb', buffering=CACHE_BUFFER_SIZE) as writer:
+        writer.write(data)
+        if sync:
+            writer.flush()
+            os.fsync(writer.fileno())
+
+
+def _loadPickleCache(cacheFilePath):
+    """
+    Load the pickle sidecar (cache.pkl) of the JSON cache file,
+    but only if it is at least as recent as the JSON cache.
+
+    The sidecar is written by this script into the user's own output directory,
+    so it is trusted like the JSON cache itself.
+
+    Returns:
+        tuple: The state of the manga (see Manga.toState). None if there is no usable sidecar.
+    """
+    picklePath = os.path.splitext(cacheFilePath)[0] + '.pkl'
+    try:
+        if os.stat(picklePath).st_mtime_ns < os.stat(cacheFilePath).st_mtime_ns:
+            return None
+        with open(picklePath, 'rb', buffering=CACHE_BUFFER_SIZE) as inputFile:
+            version, state = pickle.load(inputFile)
+        if version != PICKLE_CACHE_VERSION:
+            raise ValueError(f'Unsupported pickle cache version {version}')
+        return state
+    except Exception as err:  # pylint: disable=broad-except
+        logger.debug('Pickle cache of %s is not usable, %s', cacheFilePath, err)
+        return None
+
 
 class Manga:
     """
@@ -24,8 +102,18 @@ class Manga:
         url (str): The URL of the main manga page.
         title (str): The title of the manga.
         chapters (list of Chapter): List of the chapters of the manga.
+
+    Note:
+        The attributes are declared in __slots__. Subclasses must declare
+        their own __slots__ too, otherwise their instances get a __dict__ back.
     """
 
+    __slots__ = ('url', 'title', 'chapters', '_directoryName', '_cacheLock',
+                 '_saveGeneration', '_savedGeneration', '__weakref__')
+
+    # The elements of the manga HTML that are parsed into the soup (see makeSoup)
+    PARSE_STRAINER = getattr(impl, 'MANGA_PARSE_STRAINER', None)
+
     ################################################################################################
     # INITIALIZATION
     ################################################################################################
@@ -36,11 +124,14 @@ class Manga:
         self.chapters = chapters if chapters is not None else []
 
         self._directoryName = None  # Cache of the directoryName property
-        self._cacheLock = Lock()  # Lock for thread-safe saving of JSON cache
+        self._cacheLock = None  # Lock for thread-safe saving of JSON cache, created on first save
+        self._saveGeneration = 0  # The number of the latest snapshot taken for the cache
+        self._savedGeneration = 0  # The number of the snapshot that the cache files hold
 
-        logger.debug('Initialized manga %s (%s): %s', url,
-                     'untitled' if title is None else title,
-                     'No chapters' if chapters is None else str(len(chapters)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Initialized manga %s (%s): %s', url,
+                         'untitled' if title is None else title,
+                         'No chapters' if chapters is None else str(len(chapters)))
 
     @classmethod
     def fromCache(cls, cacheFilePath):
@@ -56,13 +147,20 @@ class Manga:
 
         logger.debug('Loading cache file: %s...', cacheFilePath)
 
-        if not os.path.exists(cacheFilePath):
-            raise IOError(f'JSON cache ({cacheFilePath}) not found.')
+        # Prefer the faster pickle sidecar, fall back to the JSON cache
+        state = _loadPickleCache(cacheFilePath)
+        if state is not None:
+            logger.debug('Pickle cache of %s loaded successfully.', cacheFilePath)
+            return Manga.fromState(state)
+
+        try:
+            with open(cacheFilePath, 'rb', buffering=CACHE_BUFFER_SIZE) as inputFile:
+                jsonData = _loadJson(inputFile.read())
+        except FileNotFoundError:
+            raise IOError(f'JSON cache ({cacheFilePath}) not found.') from None
 
-        with open(cacheFilePath, 'r') as inputFile:
-            jsonData = json.load(inputFile)
-            logger.debug('Cache file loaded and parsed to JSON successfully: %s', cacheFilePath)
-            return Manga.fromJson(jsonData)
+        logger.debug('Cache file loaded and parsed to JSON successfully: %s', cacheFilePath)
+        return Manga.fromJson(jsonData)
 
     @classmethod
     def fromJson(cls, jsonData):
@@ -84,8 +182,26 @@ class Manga:
         manga = cls(url, title)
 
         # Instantiate the chapters by passing the manga
-        chapters = [Chapter.fromJson(manga, chapter) for chapter in jsonData['chapters']]
-        manga.chapters = chapters
+        manga.chapters = Chapter.fromJsonList(manga, jsonData['chapters'])
+
+        logger.debug("Manga '%s' instantiated successfully.", title)
+        return manga
+
+    @classmethod
+    def fromState(cls, state):
+        """
+        Instantitate a Manga from its tuple representation (see toState).
+
+        Parameters:
+            state (tuple): The tuple representation of the Manga.
+
+        Returns:
+            Manga: The instantiated Manga.
+        """
+        url, title, chapterStates = state
+
+        manga = cls(url, title)
+        manga.chapters = Chapter.fromStateList(manga, chapterStates)
 
         return manga
 
@@ -108,12 +224,7 @@ class Manga:
 
         logger.debug("Converting manga title (%s) to manga directory name...", self.title)
 
-        mangaDirName = self.title
-        invalidFilenameChars = '<>:"/\\|?*.'
-        for invalidChar in invalidFilenameChars:
-            mangaDirName = mangaDirName.replace(invalidChar, '_')
-
-        self._directoryName = mangaDirName
+        self._directoryName = makeSafeFilename(self.title)
 
         logger.debug("Directory name of Manga '%s' is '%s'.", self.title, self._directoryName)
         return self._directoryName
@@ -169,11 +280,8 @@ class Manga:
         ##################################################
 
         # Instantiate a list of skeleton chapters (chapters containing only the url).
-        chapters = []
-        for idx, chapterUrl in enumerate(chapterUrls):
-            chapterNum = idx + 1
-            chapterTitle = f'Chapter {chapterNum:03}'
-            chapters.append(Chapter(self, chapterNum, chapterUrl, chapterTitle))
+        chapters = [Chapter(self, chapterNum, chapterUrl, f'Chapter {chapterNum:03}')
+                    for chapterNum, chapterUrl in enumerate(chapterUrls, 1)]
 
         logger.debug("Parsed %d chapters from soup (%s).", len(chapters), self.url)
         return chapters
@@ -195,7 +303,7 @@ class Manga:
         logger.debug('Successfully fetched manga from %s...', self.url)
 
         logger.debug('Parsing manga into soup: %s...', self.url)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = makeSoup(response.content, response.encoding or 'utf-8', self.PARSE_STRAINER)
         logger.debug('Successfully parsed manga into soup: %s', self.url)
 
         self.updateWithSoup(soup)
@@ -246,22 +354,23 @@ class Manga:
         # Update the title
         self.title = cachedManga.title
 
+        # Index both versions by chapter number
+        freshChapters = {chapter.num: chapter for chapter in self.chapters}
+        cachedChapters = {chapter.num: chapter for chapter in cachedManga.chapters}
+
         # For every chapter in the fresh version, if it exists in the cache,
         # set its information to be equal that of the cache.
-        for freshChapter in self.chapters:
-            for cachedChapter in cachedManga.chapters:
-                if freshChapter.num == cachedChapter.num:
-                    freshChapter.url = cachedChapter.url
-                    freshChapter.title = cachedChapter.title
-                    freshChapter.pages = cachedChapter.pages
-                    break
+        for num, freshChapter in freshChapters.items():
+            cachedChapter = cachedChapters.get(num)
+            if cachedChapter is not None:
+                freshChapter.url = cachedChapter.url
+                freshChapter.title = cachedChapter.title
+                freshChapter.pages = cachedChapter.pages
 
         # For every chapter in the cached version, if it does NOT exist in the fresh version,
         # add it to the list of chapters of the fresh manga.
-        for cachedChapter in cachedManga.chapters:
-            # Check if the cached chapter does not exist in the fresh manga
-            if not any([freshChapter.num == cachedChapter.num for freshChapter in self.chapters]):
-                self.chapters.append(cachedChapter)
+        self.chapters.extend(cachedChapter for num, cachedChapter in cachedChapters.items()
+                             if num not in freshChapters)
 
         # Finally, sort the chapters according to the order number
         self.chapters.sort(key=lambda chapter: chapter.num)
@@ -280,53 +389,96 @@ class Manga:
 
     def save(self, outputDir):
         """
-        Save the manga as a JSON file.
+        Save the manga as a JSON file, along with a pickle sidecar for faster loading.
 
         Parameters:
             outputDir (str): The output directory.
         """
-        logger.debug("Saving JSON cache to %s: %s", outputDir, repr(self))
-
-        self._cacheLock.acquire()
-
-        try:
-            if self.directoryName is None:
-                raise AttributeError('Directory name not found.')
-
-            outputDir = os.path.join(outputDir, self.directoryName)
-            filePath = os.path.join(outputDir, 'cache.json')
-
-            os.makedirs(outputDir, exist_ok=True)
-
-            with open(filePath, 'w') as writer:
-                jsonStr = json.dumps(self.toDict(), indent=4)
-                writer.write(jsonStr)
-                logger.debug("Saved JSON cache of '%s' to: %s", self.title, filePath)
-        except:
-            self._cacheLock.release()
-            raise
-        else:
-            self._cacheLock.release()
+        logger.debug("Saving JSON cache to %s: %r", outputDir, self)
+
+        if self.directoryName is None:
+            raise AttributeError('Directory name not found.')
+
+        # The directory name has no path separators left in it, so plain concatenation is safe.
+        outputDir = f'{outputDir}{os.sep}{self.directoryName}'
+        filePath = f'{outputDir}{os.sep}cache.json'
+        picklePath = f'{outputDir}{os.sep}cache.pkl'
+
+        # The snapshot is numbered under the lock, so that the order of the numbers is the order
+        # in which the snapshots were taken. Only the slow part, serializing and writing it,
+        # runs without the lock, and savers don't wait on each other for it.
+        with self._getCacheLock():
+            self._saveGeneration += 1
+            generation = self._saveGeneration
+            jsonData = self.toDict()
+            state = self.toState()
+
+        payload = _dumpJson(jsonData)
+        picklePayload = pickle.dumps((PICKLE_CACHE_VERSION, state),
+                                     protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.makedirs(outputDir, exist_ok=True)
+
+        # Each saver writes its own temporary files. The JSON is synced to the disk before it
+        # is swapped in, so that a crash never leaves a truncated cache file behind.
+        # The pickle sidecar is only a shortcut for loading, so it doesn't need to be synced.
+        tempFilePath = f'{filePath}.{generation}.tmp'
+        tempPicklePath = f'{picklePath}.{generation}.tmp'
+        _writeFile(tempFilePath, payload, sync=True)
+        _writeFile(tempPicklePath, picklePayload, sync=False)
+
+        with self._getCacheLock():
+            # A saver that took a newer snapshot has already written it, so this one is dropped
+            # instead of overwriting the newer cache with older data
+            isStale = generation < self._savedGeneration
+            if not isStale:
+                # The pickle sidecar is swapped in after the JSON so that it is never older than it
+                os.replace(tempFilePath, filePath)
+                os.replace(tempPicklePath, picklePath)
+                self._savedGeneration = generation
+
+        if isStale:
+            os.remove(tempFilePath)
+            os.remove(tempPicklePath)
+            logger.debug("Skipped an outdated save of the JSON cache of '%s'.", self.title)
+            return
+
+        logger.debug("Saved JSON cache of '%s' to: %s", self.title, filePath)
+
+    def _getCacheLock(self):
+        """
+        Get the lock for thread-safe saving of the JSON cache, creating it if necessary.
+        Mangas that are only loaded from the cache and never saved don't allocate a lock.
+        """
+        if self._cacheLock is None:
+            with _cacheLockInitLock:
+                if self._cacheLock is None:
+                    self._cacheLock = Lock()
+        return self._cacheLock
 
     ################################################################################################
     # REPRESENTATION
     ################################################################################################
 
     def __str__(self):
-        result = ''
-        result += f'URL: {self.url}\n'
-        result += f'Title: {self.title}\n'
+        parts = [f'URL: {self.url}', f'Title: {self.title}']
         if len(self.chapters) > 0:
-            result += '\n'.join(f'{str(chapter)}\n' for chapter in self.chapters)
+            parts.extend(str(chapter) for chapter in self.chapters)
         else:
-            result += '(No chapters)'
-        return result
+            parts.append('(No chapters)')
+        return '\n'.join(parts)
 
     def __repr__(self):
         title = 'Untitled' if self.title is None else self.title
         chapters = 'No chapters' if len(self.chapters) == 0 else f'{len(self.chapters)} chapters'
         return f'{self.url}  ({title})  ({chapters})'
 
+    def toState(self):
+        """
+        Returns the compact tuple representation of the Manga, used by the pickle cache.
+        """
+        return (self.url, self.title, [chapter.toState() for chapter in self.chapters])
+
     def toDict(self):
         """
         Returns the dictionary representation of the Manga.
@@ -3,14 +3,25 @@ A model of a page of a manga.
 """
 
 import os
+import sys
+import shutil
 import logging
 import weakref
+from operator import itemgetter
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
 
 from downloader import Downloader
 
 
 logger = logging.getLogger(__name__)
 
+# The image extensions that can be downloaded
+VALID_IMAGE_EXTS = frozenset(('png', 'jpg', 'jpeg'))
+
+# Extracts the tuple representation of a Page (see Page.toState) from its JSON representation
+_getPageJsonFields = itemgetter('num', 'pageUrl', 'imageUrl', 'filePath', 'filename',
+                                'isDownloaded')
+
 
 class Page:
     """
@@ -28,8 +39,15 @@ class Page:
         isDownloaded (bool): True if the page image has already been downloaded.
         isProcessed (bool): True if an attempt to download the image has been executed.
             This will always initialize to False whenever a Page is instantiated.
+
+    Note:
+        Pages are by far the most numerous objects, so their attributes live in __slots__.
+        Subclasses have to declare __slots__ as well to keep that saving.
     """
 
+    __slots__ = ('_chapter', 'chapterNum', 'mangaTitle', 'num', 'pageUrl', 'imageUrl',
+                 'filePath', 'filename', 'isDownloaded', 'isProcessed')
+
     ################################################################################################
     # INITIALIZATION
     ################################################################################################
@@ -38,6 +56,7 @@ class Page:
                  filePath=None, filename=None, isDownloaded=False):
         self._chapter = weakref.ref(chapter)
         self.chapterNum = chapter.num
+        # The chapter's title is interned, so every page of the manga shares a single copy of it
         self.mangaTitle = chapter.mangaTitle
         self.num = num
         self.pageUrl = pageUrl
@@ -48,24 +67,52 @@ class Page:
         self.isProcessed = False
 
     @classmethod
-    def fromJson(cls, chapter, jsonData):
+    def fromJsonList(cls, chapter, jsonList):
+        """
+        Instantitate all the Pages of a chapter from their JSON representations.
+
+        Parameters:
+            chapter (Chapter): The parent chapter who owns these pages.
+            jsonList (list of json): The JSON representations of the pages.
+
+        Returns:
+            list of Page: The instantiated Pages.
+        """
+        return cls.fromStateList(chapter, map(_getPageJsonFields, jsonList))
+
+    @classmethod
+    def fromStateList(cls, chapter, stateList):
         """
-        Instantitate a Page from its JSON representation.
+        Instantitate all the Pages of a chapter from their tuple representations (see toState).
 
         Parameters:
-            chapter (Chapter): The parent chapter who owns this page.
-            jsonData (json): The JSON representation of the page.
+            chapter (Chapter): The parent chapter who owns these pages.
+            stateList (iterable of tuple): The tuple representations of the pages.
 
         Returns:
-            Page: The instantiated Page.
+            list of Page: The instantiated Pages.
+
+        Note:
+            The slots are written directly instead of going through __init__, and the values
+            taken from the chapter are looked up once for all of its pages. A slot added to
+            __init__ has to be added here as well.
         """
-        num = jsonData['num']
-        pageUrl = jsonData['pageUrl']
-        imageUrl = jsonData['imageUrl']
-        filePath = jsonData['filePath']
-        filename = jsonData['filename']
-        isDownloaded = jsonData['isDownloaded']
-        return cls(chapter, num, pageUrl, imageUrl, filePath, filename, isDownloaded)
+        chapterRef = weakref.ref(chapter)
+        chapterNum = chapter.num
+        mangaTitle = chapter.mangaTitle
+
+        pages = []
+        for state in stateList:
+            page = cls.__new__(cls)
+            page._chapter = chapterRef
+            page.chapterNum = chapterNum
+            page.mangaTitle = mangaTitle
+            (page.num, page.pageUrl, page.imageUrl,
+             page.filePath, page.filename, page.isDownloaded) = state
+            page.isProcessed = False
+            pages.append(page)
+
+        return pages
 
     ################################################################################################
     # WEAK REF PROPERTIES
@@ -122,29 +169,26 @@ class Page:
             str: The filename for the image download file.
         """
 
-        logger.debug('Getting filename of Chapter %d Page %d (%s)...',
-                     self.chapterNum, self.num, self.imageUrl)
+        imageUrl = self.imageUrl
 
         # Check that the image URL is not None
-        if self.imageUrl is None:
+        if imageUrl is None:
             raise AttributeError('Image URL not found.')
 
-        if '.' not in self.imageUrl:
+        dotIdx = imageUrl.rfind('.')
+        if dotIdx < 0:
             raise ValueError('Image URL is not a valid image type.')
 
-        # Get the image extension from the image URL
-        ext = self.imageUrl.rsplit('.', 1)[-1]
+        # Get the image extension from the image URL, ignoring its case (e.g. '.JPG')
+        ext = imageUrl[dotIdx + 1:].lower()
 
         # Check that the extension is a valid image type
-        validExts = ['png', 'jpg', 'jpeg']
-        if ext not in validExts:
+        if ext not in VALID_IMAGE_EXTS:
             raise ValueError('Image URL is not a valid image type.')
 
-        # Filename is the order number as a 4-digit number with the valid extension
-        filename = f'{(self.num):04}.{ext}'
-
-        logger.debug("Filename of Chapter %d Page %d is '%s'...",
-                     self.chapterNum, self.num, filename)
+        # Filename is the order number as a 4-digit number with the valid extension.
+        # Interned because every chapter repeats the same filenames.
+        filename = sys.intern(f'{(self.num):04}.{ext}')
 
         return filename
 
@@ -160,7 +204,7 @@ class Page:
             chapter (Chapter): The new chapter parent.
         """
         self._chapter = weakref.ref(chapter)
-        self.mangaTitle = chapter.manga.title
+        self.mangaTitle = chapter.mangaTitle
         self.chapterNum = chapter.num
 
     ################################################################################################
@@ -193,19 +237,173 @@ class Page:
     def downloadImage(self, outputDir):
         """
         Download the image and save it to the output directory.
+        Nothing is downloaded if the image is already in its download path.
         """
-        logger.debug("Downloading image of '%s' Chapter %d Page %d (%s) as '%s'...",
-                     self.mangaTitle, self.chapterNum, self.num,
-                     self.imageUrl, self.filename)
+        if self.isDownloaded and self.filePath is not None and os.path.exists(self.filePath):
+            return
 
-        if self.imageUrl is None:
-            raise AttributeError('Image URL not found.')
+        # Checked up front because this runs for every page, and DEBUG is usually off
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Downloading image of '%s' Chapter %d Page %d (%s) as '%s'...",
+                         self.mangaTitle, self.chapterNum, self.num,
+                         self.imageUrl, self.filename)
 
-        if self.filename is None:
-            self.filename = self.getImageFilename()
+        self._downloadImageTo(self._makeChapterDirectory(self.chapter, outputDir))
+
+    @classmethod
+    def downloadImagesBatch(cls, pages, outputDir, concurrency=8, pool=None, stopEvent=None):
+        """
+        Download the images of the given pages concurrently.
+        Pages that have already been downloaded are skipped.
 
-        mangaDirName = self.manga.directoryName
-        chapterDirName = self.chapter.directoryName
+        The pages must all belong to the same chapter, so that the chapter directory
+        is resolved and created once for the whole batch instead of once per page.
+
+        Pages that share an image URL (e.g. a credits page repeated in the chapter)
+        only download it once, and the other pages get a link to the downloaded file.
+
+        Parameters:
+            pages (list of Page): The pages of a single chapter.
+            outputDir (str): The output directory.
+            concurrency (int): The maximum number of simultaneous downloads.
+                Keep it low so that the manga host doesn't throttle or ban the crawler.
+            pool (AdaptivePool): The pool to run the downloads on, which adjusts the number
+                of simultaneous downloads to the host instead. It is not shut down afterwards,
+                so it can be shared by the batches of the same host.
+                If None, a pool of the given concurrency is used for this batch only.
+            stopEvent (Event): If set, the downloads that haven't started yet are cancelled,
+                and their pages are left unprocessed. The running downloads are waited for.
+
+        Returns:
+            list of (Page, Exception): The pages that failed to be downloaded, with the errors.
+        """
+        pages = [page for page in pages if not page.isDownloaded]
+        if len(pages) == 0:
+            return []
+
+        outputDir = cls._makeChapterDirectory(pages[0].chapter, outputDir)
+        uniquePages, duplicatePages = cls._groupByImageUrl(pages)
+
+        executor = pool if pool is not None else ThreadPoolExecutor(max_workers=concurrency)
+        try:
+            failedPages = cls._waitForDownloads(executor, uniquePages, outputDir, stopEvent)
+        finally:
+            if pool is None:
+                executor.shutdown()
+
+        failedPages.extend(cls._linkDuplicates(duplicatePages, failedPages, outputDir))
+        return failedPages
+
+    @staticmethod
+    def _groupByImageUrl(pages):
+        """
+        Pick the pages whose images have to be downloaded. Only the first page with
+        each image URL is downloaded, the rest will link to the file of that page.
+
+        Parameters:
+            pages (list of Page): The pages to be downloaded.
+
+        Returns:
+            list of Page: The pages whose images have to be downloaded.
+            list of (Page, Page): The other pages, each paired with the page
+                whose downloaded file it will link to.
+        """
+        sourcePages = {}
+        uniquePages = []
+        duplicatePages = []
+        for page in pages:
+            sourcePage = sourcePages.get(page.imageUrl) if page.imageUrl is not None else None
+            if sourcePage is None:
+                sourcePages[page.imageUrl] = page
+                uniquePages.append(page)
+            else:
+                duplicatePages.append((page, sourcePage))
+        return uniquePages, duplicatePages
+
+    @classmethod
+    def _waitForDownloads(cls, executor, pages, outputDir, stopEvent):
+        """
+        Submit the downloads of the pages to the executor and wait for them to finish.
+
+        Parameters:
+            executor (ThreadPoolExecutor or AdaptivePool): What the downloads are run on.
+            pages (list of Page): The pages whose images are downloaded.
+            outputDir (str): The absolute path of the chapter directory.
+            stopEvent (Event): If set, the downloads that haven't started yet are cancelled.
+
+        Returns:
+            list of (Page, Exception): The pages that failed to be downloaded, with the errors.
+        """
+        failedPages = []
+        futures = {executor.submit(cls._downloadImageTo, page, outputDir): page
+                   for page in pages}
+        pending = set(futures)
+        while pending:
+            # Wake up regularly to check the stop event, like the crawler threads do
+            done, pending = wait(pending, timeout=0.3, return_when=FIRST_COMPLETED)
+            for future in done:
+                # The pool cancels the downloads that were still waiting for their turn
+                if future.cancelled() or isinstance(future.exception(), CancelledError):
+                    continue
+                page = futures[future]
+                page.isProcessed = True
+                err = future.exception()
+                if err is not None:
+                    failedPages.append((page, err))
+            if stopEvent is not None and stopEvent.is_set():
+                # A future that is cancelled before it starts is never reported as done
+                # by wait(), so only the ones that couldn't be cancelled are waited for
+                pending = {future for future in pending if not future.cancel()}
+        return failedPages
+
+    @classmethod
+    def _linkDuplicates(cls, duplicatePages, failedPages, outputDir):
+        """
+        Link the pages that share an image URL to the file downloaded for their source page.
+        The pages whose source page wasn't downloaded get the same error,
+        and the ones whose source page was cancelled are left unprocessed.
+
+        Parameters:
+            duplicatePages (list of (Page, Page)): The pages, each paired with its source page.
+            failedPages (list of (Page, Exception)): The source pages that failed to be downloaded.
+            outputDir (str): The absolute path of the chapter directory.
+
+        Returns:
+            list of (Page, Exception): The pages that failed to be linked, with the errors.
+        """
+        failedLinks = []
+        sourceErrors = dict(failedPages)
+        for page, sourcePage in duplicatePages:
+            if not sourcePage.isProcessed:
+                continue
+            page.isProcessed = True
+            err = sourceErrors.get(sourcePage)
+            if err is None:
+                try:
+                    cls._linkImageFrom(page, sourcePage, outputDir)
+                except Exception as linkErr:  # pylint: disable=broad-except
+                    err = linkErr
+            if err is not None:
+                failedLinks.append((page, err))
+        return failedLinks
+
+    @staticmethod
+    def _makeChapterDirectory(chapter, outputDir):
+        """
+        Create the directory where the images of the chapter are downloaded.
+
+        The parent chapter and manga are looked up once here, so the downloads themselves
+        don't have to go through the weak references again.
+
+        Parameters:
+            chapter (Chapter): The chapter whose images are downloaded.
+            outputDir (str): The output directory.
+
+        Returns:
+            str: The absolute path of the chapter directory.
+        """
+        mangaDirName = chapter.manga.directoryName
+        chapterDirName = chapter.directoryName
 
         if mangaDirName is None:
             raise AttributeError('Manga directory name not found.')
@@ -213,23 +411,75 @@ class Page:
         if chapterDirName is None:
             raise AttributeError('Chapter directory name not found.')
 
-        outputDir = os.path.join(outputDir, mangaDirName, chapterDirName)
+        # The crawler already passes an absolute directory, which saves a getcwd call per page
+        if not os.path.isabs(outputDir):
+            outputDir = os.path.abspath(outputDir)
 
-        outputPath = os.path.join(outputDir, self.filename)
-        logger.debug("Output path for the image of '%s' Chapter %d Page %d is: %s",
-                     self.mangaTitle, self.chapterNum, self.num, outputDir)
+        outputDir = os.path.join(outputDir, mangaDirName, chapterDirName)
 
         os.makedirs(outputDir, exist_ok=True)
 
+        return outputDir
+
+    def _downloadImageTo(self, outputDir):
+        """
+        Download the image into the chapter directory, which must already exist.
+
+        Parameters:
+            outputDir (str): The absolute path of the chapter directory.
+        """
+        if self.imageUrl is None:
+            raise AttributeError('Image URL not found.')
+
+        if self.filename is None:
+            self.filename = self.getImageFilename()
+
+        # The directory is already absolute and the filename is a bare name,
+        # so a plain concatenation is all that os.path.join would do here
+        outputPath = outputDir + os.sep + self.filename
+
         err = Downloader.downloadImage(self.imageUrl, outputPath)
         if err is not None:
             raise err
 
-        self.filePath = os.path.abspath(outputPath)
+        self.filePath = outputPath
         self.isDownloaded = True
 
-        logger.debug("Successfully downloaded image of '%s' Chapter %d Page %d to %s",
-                     self.mangaTitle, self.chapterNum, self.num, self.filePath)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Successfully downloaded image of '%s' Chapter %d Page %d to %s",
+                         self.mangaTitle, self.chapterNum, self.num, self.filePath)
+
+    def _linkImageFrom(self, sourcePage, outputDir):
+        """
+        Use the image that was downloaded for another page with the same image URL.
+        The file is hard-linked if the file system allows it, and copied otherwise.
+
+        Parameters:
+            sourcePage (Page): The page whose image has already been downloaded.
+            outputDir (str): The absolute path of the chapter directory.
+        """
+        if self.filename is None:
+            self.filename = self.getImageFilename()
+
+        outputPath = outputDir + os.sep + self.filename
+
+        # A link can't replace an existing file, e.g. one left by an interrupted download
+        try:
+            os.remove(outputPath)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(sourcePage.filePath, outputPath)
+        except OSError:
+            shutil.copyfile(sourcePage.filePath, outputPath)
+
+        self.filePath = outputPath
+        self.isDownloaded = True
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Linked image of '%s' Chapter %d Page %d to the one of Page %d",
+                         self.mangaTitle, self.chapterNum, self.num, sourcePage.num)
 
     ################################################################################################
     # REPRESENTATION
@@ -243,6 +493,14 @@ class Page:
         filename = 'No filename' if self.filename is None else self.filename
         return f'Page {self.num}: {imageUrl}  ({filename})  ({self.isDownloaded})'
 
+    def toState(self):
+        """
+        Returns the compact tuple representation of the Page, in the field order of toDict.
+        This is what the pickle cache stores, since tuples pickle smaller and faster than dicts.
+        """
+        return (self.num, self.pageUrl, self.imageUrl,
+                self.filePath, self.filename, self.isDownloaded)
+
     def toDict(self):
         """
         Returns the dictionary representation of the Page.
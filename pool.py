@@ -0,0 +1,181 @@
+"""
+A thread pool for downloads that adapts its concurrency to how the host responds.
+"""
+
+import time
+import logging
+from threading import Condition
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+from downloader import DownloaderError
+
+
+logger = logging.getLogger(__name__)
+
+# The HTTP status codes with which a host says that it is receiving too many requests
+THROTTLE_STATUS_CODES = frozenset((429, 503))
+
+# The longest time in seconds to stop sending requests after the host throttles the crawler
+MAX_BACKOFF = 60
+
+
+class AdaptivePool:
+    """
+    A thread pool whose number of simultaneous tasks adapts to how the host responds.
+
+    It starts with a few simultaneous tasks and allows one more after every run of
+    consecutive successes. When the host throttles a task (429 or 503), the limit is halved,
+    no task is started for the time that the host asked for in Retry-After (or an
+    exponentially growing delay if it didn't), and the throttled task is retried.
+
+    The pool is meant to be shared by the batches of the same host, so that each
+    batch starts from what the previous ones have learned.
+
+    Attributes:
+        limit (int): The current maximum number of simultaneous tasks.
+    """
+
+    ################################################################################################
+    # INITIALIZATION
+    ################################################################################################
+
+    def __init__(self, maxConcurrency=8, initialConcurrency=2, rampUpAfter=10, maxRetries=3):
+        """
+        Parameters:
+            maxConcurrency (int): The highest that the limit can go.
+            initialConcurrency (int): The limit to start with.
+            rampUpAfter (int): The number of consecutive successes needed to raise the limit.
+            maxRetries (int): The number of times a throttled task is retried before
+                its error is raised.
+        """
+        self.maxConcurrency = maxConcurrency
+        self.rampUpAfter = rampUpAfter
+        self.maxRetries = maxRetries
+        self.limit = max(1, min(initialConcurrency, maxConcurrency))
+
+        self._condition = Condition()
+        self._active = 0            # The number of tasks that are currently running
+        self._successStreak = 0     # The number of consecutive successful tasks
+        self._backoffCount = 0      # The number of consecutive throttles, for the delay
+        self._resumeTime = 0.0      # The monotonic time before which no task is started
+        self._cancelled = False     # True once the tasks that haven't started are cancelled
+
+        self._executor = ThreadPoolExecutor(max_workers=maxConcurrency,
+                                            thread_name_prefix='AdaptivePoolThread')
+
+    ################################################################################################
+    # SUBMIT
+    ################################################################################################
+
+    def submit(self, fn, *args):
+        """
+        Schedule the function to be run with the given arguments.
+
+        Parameters:
+            fn (callable): The task, e.g. a page download.
+            args: The arguments of the task.
+
+        Returns:
+            Future: The future of the task's result.
+        """
+        return self._executor.submit(self._run, fn, args)
+
+    def shutdown(self, wait=True, cancelFutures=False):
+        """
+        Stop accepting tasks and release the threads once the scheduled tasks are done.
+
+        Parameters:
+            wait (bool): If True, wait until the running tasks are done.
+            cancelFutures (bool): If True, cancel the tasks that haven't started,
+                including the ones waiting for the limit or the backoff delay.
+                Their futures are either cancelled or raise CancelledError.
+        """
+        if cancelFutures:
+            with self._condition:
+                self._cancelled = True
+                self._condition.notify_all()
+        self._executor.shutdown(wait=wait, cancel_futures=cancelFutures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.shutdown()
+
+    ################################################################################################
+    # CONCURRENCY CONTROL
+    ################################################################################################
+
+    def _run(self, fn, args):
+        """
+        Run the task when the limit allows it, retrying it if the host throttles it.
+        """
+        attempt = 0
+        while True:
+            self._acquire()
+            throttleError = None
+            succeeded = False
+            try:
+                result = fn(*args)
+                succeeded = True
+                return result
+            except DownloaderError as err:
+                # The limit is lowered on every throttle, even when the task is out of retries
+                if err.statusCode in THROTTLE_STATUS_CODES:
+                    throttleError = err
+                if throttleError is None or attempt >= self.maxRetries:
+                    raise
+            finally:
+                self._release(succeeded, throttleError)
+            attempt += 1
+
+    def _acquire(self):
+        """
+        Wait until the backoff delay is over and the number of running tasks is below the limit.
+        """
+        with self._condition:
+            while True:
+                if self._cancelled:
+                    raise CancelledError()
+                waitTime = self._resumeTime - time.monotonic()
+                if waitTime > 0:
+                    self._condition.wait(waitTime)
+                elif self._active >= self.limit:
+                    self._condition.wait()
+                else:
+                    break
+            self._active += 1
+
+    def _release(self, succeeded, throttleError):
+        """
+        Update the limit based on how the task went, and let the waiting tasks through.
+
+        Parameters:
+            succeeded (bool): True if the task didn't raise an error.
+            throttleError (DownloaderError): The error if the host throttled the task, else None.
+        """
+        with self._condition:
+            self._active -= 1
+
+            if throttleError is not None:
+                self._successStreak = 0
+                self._backoffCount += 1
+                self.limit = max(1, self.limit // 2)
+                delay = throttleError.retryAfter
+                if delay is None:
+                    delay = 2 ** self._backoffCount
+                delay = min(delay, MAX_BACKOFF)
+                self._resumeTime = max(self._resumeTime, time.monotonic() + delay)
+                logger.warning('Throttled by the host (status %d), lowering the concurrency '
+                               'to %d and waiting %.1f seconds...',
+                               throttleError.statusCode, self.limit, delay)
+
+            elif succeeded:
+                self._backoffCount = 0
+                self._successStreak += 1
+                if self._successStreak >= self.rampUpAfter and self.limit < self.maxConcurrency:
+                    self._successStreak = 0
+                    self.limit += 1
+                    logger.debug('Raising the concurrency to %d.', self.limit)
+
+            self._condition.notify_all()
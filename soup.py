@@ -0,0 +1,38 @@
+"""
+Functions related to parsing HTML into soup.
+"""
+
+# The C-based parser, used whenever it is installed
+PARSER = 'lxml'
+
+# The pure-Python parser bundled with Python, used when lxml is not installed
+FALLBACK_PARSER = 'html.parser'
+
+
+def makeSoup(markup, encoding=None, parseOnly=None):
+    """
+    Parse the HTML into soup, using lxml if it is installed.
+
+    Manga and Chapter pass their PARSE_STRAINER as parseOnly. The site-specific implementation
+    sets them by defining MANGA_PARSE_STRAINER and CHAPTER_PARSE_STRAINER in impl.py, e.g.
+    SoupStrainer(['title', 'a']), to cover the elements that its getters read from each page.
+    Either one can be left out to parse the whole document. A strainer must be widened whenever
+    the getters start reading other elements, or they will no longer find them in the soup.
+
+    Parameters:
+        markup (bytes): The raw HTML.
+        encoding (str): The encoding of the HTML. None to let BeautifulSoup detect it.
+        parseOnly (SoupStrainer): If given, only the matching elements are added to the soup.
+            None to parse the whole document.
+
+    Returns:
+        BeautifulSoup: The HTML soup.
+    """
+    # Imported here so that runs which only download from the cache never load bs4
+    from bs4 import BeautifulSoup, FeatureNotFound  # pylint: disable=import-outside-toplevel
+
+    try:
+        return BeautifulSoup(markup, PARSER, from_encoding=encoding, parse_only=parseOnly)
+    except FeatureNotFound:
+        return BeautifulSoup(markup, FALLBACK_PARSER, from_encoding=encoding,
+                             parse_only=parseOnly)